@@ -0,0 +1,85 @@
+import java.awt.image.BufferedImage;
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.util.regex.Matcher;
+import java.util.regex.Pattern;
+
+import javax.imageio.ImageIO;
+
+import net.sourceforge.plantuml.ugraphic.sprite.SpriteGrayLevel;
+import net.sourceforge.plantuml.ugraphic.sprite.SpriteUtils;
+
+/**
+ * Long-lived sprite encoder for puml.py, so that the JVM is started once per
+ * run instead of once per icon.
+ *
+ * Each line read from stdin is a request of the form "SIZE IMAGE_PATH", where
+ * SIZE is any value accepted by PlantUML's -encodesprite switch (4, 8 or 16,
+ * optionally suffixed with z). The response is what
+ * "java -jar plantuml.jar -encodesprite SIZE IMAGE_PATH" prints for a valid
+ * request, followed by a line containing only the END marker. Failures,
+ * including sizes the jar would reject, are reported as a single line
+ * starting with the ERROR marker, followed by the END marker.
+ *
+ * Run it straight from source (Java 11+) with:
+ *
+ *     java -Djava.awt.headless=true -cp plantuml.jar SpriteWorker.java
+ */
+public class SpriteWorker {
+    static final String END = "%%SPRITE-END%%";
+    static final String ERROR = "%%SPRITE-ERROR%% ";
+    static final Pattern SIZE = Pattern.compile("(4|8|16)z?");
+    static final Pattern NAME = Pattern.compile("^[\\p{L}0-9_]+");
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(
+                new InputStreamReader(System.in, "UTF-8"));
+        PrintStream out = new PrintStream(System.out, false, "UTF-8");
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            String[] request = line.split(" ", 2);
+            try {
+                out.println(encode(request[0], request[1]));
+            } catch (Exception e) {
+                out.println(ERROR + e);
+            }
+            out.println(END);
+            out.flush();
+        }
+    }
+
+    // Mirrors net.sourceforge.plantuml.Run#encodeSprite
+    static String encode(String size, String path) throws Exception {
+        if (!SIZE.matcher(size).matches()) {
+            throw new IllegalArgumentException("Invalid sprite size: " + size);
+        }
+        SpriteGrayLevel level = SpriteGrayLevel.GRAY_16;
+        if (size.startsWith("8")) {
+            level = SpriteGrayLevel.GRAY_8;
+        } else if (size.startsWith("4")) {
+            level = SpriteGrayLevel.GRAY_4;
+        }
+        File f = new File(path);
+        BufferedImage im = ImageIO.read(f);
+        if (im == null) {
+            throw new IllegalArgumentException("Cannot read image: " + path);
+        }
+        String name = spriteName(f);
+        if (size.endsWith("z")) {
+            return SpriteUtils.encodeCompressed(im, name, level);
+        }
+        return SpriteUtils.encode(im, name, level);
+    }
+
+    // Mirrors net.sourceforge.plantuml.Run#getSpriteName: the longest
+    // leading run of letters, digits and underscores, or "test"
+    static String spriteName(File f) {
+        Matcher m = NAME.matcher(f.getName());
+        return m.find() ? m.group() : "test";
+    }
+}
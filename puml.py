@@ -2,18 +2,27 @@
 
 import argparse
 import configparser
+import io
+import mmap
 import os.path
 import re
 import shutil
 import subprocess
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import _UNSET, NoOptionError, NoSectionError
-from hashlib import sha1
-from itertools import groupby
+from functools import lru_cache
+from hashlib import blake2b
 from operator import attrgetter
 
 SRC_DIR = os.path.realpath(os.path.dirname(__file__))
 OUTPUT_DIR = os.path.join(SRC_DIR, 'dist')
 PUML_JAR = os.path.join(SRC_DIR, 'plantuml.jar')
+SPRITE_WORKER = os.path.join(SRC_DIR, 'SpriteWorker.java')
+SPRITE_WORKER_END = b'%%SPRITE-END%%'
+SPRITE_WORKER_ERROR = b'%%SPRITE-ERROR%% '
+SPRITE_CACHE_DIR = os.path.join(SRC_DIR, '.sprite-cache')
 CONFIG_FILE = os.path.join(SRC_DIR, 'puml.ini')
 CONFIG_DEFAULTS = {
     'DEFAULT': {
@@ -44,11 +53,14 @@ CONFIG_DEFAULTS = {
         'light-red': '#F9DFDC',
         'teal': '#05ABAF'}}
 
+NONWORD_RE = re.compile(r'[^\w]')
+STEREOTYPE_SPLIT_RE = re.compile(r'_(?!\d)')
+SPRITE_HEADER_RE = re.compile(
+    r'^(\s*sprite\s+\$)\w+(\s+\[\d+x\d+/\d+\]\s*\{\s*)$', re.I)
+SPRITE_NAME_RE = re.compile(r'^\s*sprite\s+\$(\w+)', re.I | re.M)
 
-PUML_TEMPLATE = '''
-{sprite}
-{stereotype_skinparam}
-{macros}'''.strip()
+_MISSING = object()
+_UNRESOLVED = object()
 
 STEREOTYPE_SKINPARAM_TEMPLATE = '''
 skinparam {entity_type}<<{stereotype}>> {{
@@ -66,59 +78,354 @@ PUML_ENTITY(e_type,e_color,e_sprite,label,alias,e_stereo)
 
 
 class InheritingConfigParser(configparser.ConfigParser):
+    """ConfigParser where dotted sections inherit their parents' options.
+
+    An option missing from ``a.b.c`` is looked up in the wildcard section
+    ``a.b.``, then in ``a.b``, ``a.`` and finally ``a``. Resolved values are
+    memoized until the parser is next modified.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # set first, as ConfigParser.__init__ may already add sections
+        self._resolved = {}
+        self._chains = {}
+        super().__init__(*args, **kwargs)
+
     def get(self, section, option, *, raw=False, vars=None, fallback=_UNSET):
-        try:
-            return super().get(section, option, raw=raw, vars=vars, fallback=_UNSET)
-        except (NoOptionError, NoSectionError) as e:
-            parent_section = section.rpartition('.')[0]
-            if parent_section:
-                try:
-                    wildcard_section = '{}.'.format(parent_section)
-                    return super().get(wildcard_section, option, raw=raw, vars=vars, fallback=_UNSET)
-                except (NoOptionError, NoSectionError) as e2:
-                    return self.get(parent_section, option, raw=raw, vars=vars, fallback=fallback)
+        if vars is not None:
+            value = self._resolve(section, option, raw, vars)
+        else:
+            key = (section, option, raw)
+            value = self._resolved.get(key, _UNRESOLVED)
+            if value is _UNRESOLVED:
+                value = self._resolved[key] = self._resolve(section, option,
+                                                            raw, vars)
+        if value is _MISSING:
             if fallback is not _UNSET:
                 return fallback
-            raise e
+            if not self.has_section(section):
+                raise NoSectionError(section)
+            raise NoOptionError(option, section)
+        return value
+
+    def _section_chain(self, section):
+        # Sections to search, nearest first; e.g. for a.b.c that is
+        # a.b.c, a.b., a.b, a., a. Depends only on the name, so never stale.
+        chain = self._chains.get(section)
+        if chain is None:
+            chain = [section]
+            parent_section = section.rpartition('.')[0]
+            while parent_section:
+                chain.append('{}.'.format(parent_section))
+                chain.append(parent_section)
+                parent_section = parent_section.rpartition('.')[0]
+            self._chains[section] = chain
+        return chain
+
+    def _resolve(self, section, option, raw, vars):
+        # has_option() instead of catching NoOptionError/NoSectionError, as
+        # most lookups miss at least once on their way up the hierarchy
+        for candidate in self._section_chain(section):
+            if self.has_option(candidate, option):
+                return super().get(candidate, option, raw=raw, vars=vars)
+        return _MISSING
+
+    def read(self, *args, **kwargs):
+        self._resolved.clear()
+        return super().read(*args, **kwargs)
+
+    def read_file(self, *args, **kwargs):
+        self._resolved.clear()
+        return super().read_file(*args, **kwargs)
+
+    def add_section(self, section):
+        self._resolved.clear()
+        super().add_section(section)
+
+    def remove_section(self, section):
+        self._resolved.clear()
+        return super().remove_section(section)
+
+    def set(self, section, option, value=None):
+        self._resolved.clear()
+        super().set(section, option, value)
+
+    def remove_option(self, section, option):
+        self._resolved.clear()
+        return super().remove_option(section, option)
+
+
+_print_lock = threading.Lock()
+
+
+def _print(*args, **kwargs):
+    # Sprites and PUML files are written from a thread pool
+    with _print_lock:
+        print(*args, **kwargs)
+
+
+_created_dirs = set()
+
+
+def _ensure_dir(path):
+    # Most icons share their output directory with a sibling, so only the
+    # first one needs to hit the file system
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+
+def encode_sprite(size, image_path):
+    cmd = ['java', '-Djava.awt.headless=true', '-jar', PUML_JAR,
+           '-encodesprite',
+           size,
+           image_path]
+    return subprocess.check_output(cmd)
+
+
+@lru_cache(maxsize=None)
+def shift_table(shift, ignore):
+    """Build a bytes.translate table shifting sprite gray levels by shift.
+
+    Hex digits found in ignore are left untouched.
+    """
+    table = bytearray(range(256))
+    for c in '0123456789ABCDEFabcdef':
+        if c not in ignore:
+            # shift up to 15/F, convert to hex and strip leading '0x'
+            shifted = hex(min(15, shift + int(c, base=16))).upper()[-1]
+            table[ord(c)] = ord(shifted)
+    return bytes(table)
+
+
+# Equivalent to .upper().replace(b'F', b'0'): gray level F is the background
+TRANSPARENT_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyzF',
+                                    b'ABCDE0GHIJKLMNOPQRSTUVWXYZ0')
+
+
+def sprite_name(image_path):
+    """Return the name PlantUML's -encodesprite gives an image's sprite.
+
+    Like Run#getSpriteName, this is the longest leading run of letters,
+    ASCII digits and underscores in the file name, or 'test' if it is empty.
+    """
+    name = os.path.basename(image_path)
+    for i, c in enumerate(name):
+        if not (c.isalpha() or c in '0123456789_'):
+            name = name[:i]
+            break
+    return name or 'test'
+
+
+def sprite_cache_path(content_hash, size, encoder='java'):
+    # Key on the encoder too, so switching encoders or upgrading plantuml.jar
+    # never serves another encoder's output
+    jar = os.stat(PUML_JAR)
+    key = '{}:{}:{}:{}:{}'.format(content_hash, size, encoder, jar.st_size,
+                                  jar.st_mtime_ns)
+    return os.path.join(SPRITE_CACHE_DIR, '{}.sprite'.format(
+        blake2b(key.encode(), digest_size=16).hexdigest()))
+
+
+class SpriteEncoder:
+    """Encodes sprites through a pool of long-lived SpriteWorker JVMs.
+
+    Up to ``workers`` JVMs are started lazily as concurrent requests come in,
+    so runs that only reuse existing sprite files never start Java. If a
+    worker cannot be launched (e.g. Java older than 11, which cannot run
+    source files directly), every request falls back to a one-off
+    ``-encodesprite`` call.
+    """
+
+    # Identifies this encoder's output in the sprite cache; the workers print
+    # exactly what a one-off -encodesprite call does
+    cache_tag = 'java'
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers or 1)
+        self._procs = []
+        self._idle = []
+        # Guards the three fields above and _fallback; notified whenever a
+        # worker becomes idle or goes away, and when switching to fallback
+        self._cond = threading.Condition()
+        self._fallback = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self):
+        cmd = ['java', '-Djava.awt.headless=true', '-cp', PUML_JAR,
+               SPRITE_WORKER]
+        return subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+    @staticmethod
+    def _stop(proc):
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+        proc.stdout.close()
+
+    def _acquire(self):
+        """Return (proc, started), or (None, False) in fallback mode."""
+        with self._cond:
+            while not self._fallback:
+                if self._idle:
+                    return self._idle.pop(), False
+                if len(self._procs) < self.workers:
+                    proc = self._start()
+                    self._procs.append(proc)
+                    return proc, True
+                self._cond.wait()
+        return None, False
+
+    def _release(self, proc):
+        with self._cond:
+            self._idle.append(proc)
+            self._cond.notify()
+
+    def _discard(self, proc, fallback=False):
+        with self._cond:
+            self._procs.remove(proc)
+            if fallback and not self._fallback:
+                _print('Sprite worker unavailable; encoding sprites one at '
+                       'a time')
+                self._fallback = True
+            # every waiter has to re-check: start a replacement or fall back
+            self._cond.notify_all()
+        self._stop(proc)
+
+    @staticmethod
+    def _request(proc, size, image_path):
+        try:
+            request = '{} {}\n'.format(size, image_path)
+            proc.stdin.write(request.encode('utf-8'))
+            proc.stdin.flush()
+        except BrokenPipeError:
+            return None
+        lines = []
+        for line in iter(proc.stdout.readline, b''):
+            if line.rstrip(b'\r\n') == SPRITE_WORKER_END:
+                return b''.join(lines)
+            lines.append(line)
+        return None
+
+    def encode(self, size, image_path):
+        while True:
+            proc, started = self._acquire()
+            if proc is None:
+                break
+            output = self._request(proc, size, image_path)
+            if output is None:
+                # a worker that dies on its first request could not be
+                # launched at all, so stop trying to use workers
+                self._discard(proc, fallback=started)
+                if not started:
+                    raise Exception('Sprite worker exited unexpectedly')
+                continue
+            self._release(proc)
+            if output.startswith(SPRITE_WORKER_ERROR):
+                error = output[len(SPRITE_WORKER_ERROR):].decode('utf-8')
+                raise Exception('Failed to encode sprite for {}: {}'.format(
+                    image_path, error.strip()))
+            return output
+        return encode_sprite(size, image_path)
+
+    def close(self):
+        with self._cond:
+            procs, self._procs = self._procs, []
+            self._idle = []
+        for proc in procs:
+            self._stop(proc)
+
+
+class PillowSpriteEncoder:
+    """Encodes 16-level sprites in-process with Pillow, the way PlantUML does.
+
+    Java reads grayscale and 16-bit PNGs (and color profiles) differently
+    from Pillow, so only 8-bit color and palette PNGs are handled here.
+    Everything else, including other sprite sizes, is passed on to the
+    ``fallback`` encoder.
+    """
+
+    # PNG raw modes whose pixels Java reports unchanged
+    RAWMODES = {'1', 'P', 'P;1', 'P;2', 'P;4', 'RGB', 'RGBA'}
+    HEX = b'0123456789ABCDEF'
+
+    def __init__(self, fallback):
+        from PIL import __version__
+        self.fallback = fallback
+        self.cache_tag = 'pillow-{}'.format(__version__)
+
+    def encode(self, size, image_path):
+        from PIL import Image
+        with Image.open(image_path) as im:
+            if (size != '16' or im.format != 'PNG' or
+                    im.tile[0][3] not in self.RAWMODES or
+                    'icc_profile' in im.info):
+                return self.fallback.encode(size, image_path)
+            width, height = im.size
+            data = im.convert('RGBA').tobytes()
+        # Same weighting and truncation as PlantUML's ColorChangerMonochrome
+        levels = bytes(
+            self.HEX[(255 - int(r * .3 + g * .59 + b * .11)) // 16]
+            for r, g, b in zip(data[0::4], data[1::4], data[2::4]))
+        rows = b'\n'.join(levels[i:i + width]
+                          for i in range(0, len(levels), width))
+        return b'sprite $%s [%dx%d/16] {\n%s\n}\n\n' % (
+            sprite_name(image_path).encode('utf-8'), width, height, rows)
 
 
 class PUML:
-    def __init__(self, image_path, output_root_dir, conf):
+    def __init__(self, image_path, output_root_dir, conf, encoder=None):
         self.conf = conf
+        self.encoder = encoder
+        self.duplicate_of = None
         self.image_path = os.path.abspath(image_path)
         self.output_root_dir = os.path.abspath(output_root_dir)
+        # Derived from the file name alone and read constantly, so computed
+        # up front rather than behind lazy properties
+        basename = os.path.splitext(os.path.basename(self.image_path))[0]
+        parts = [NONWORD_RE.sub('_', p) for p in basename.split('_')]
+        if parts[-1] == 'LARGE':
+            self.categories, self.name = parts[:-1], '_'.join(parts[-2:])
+        else:
+            self.categories, self.name = parts, parts[-1]
+        self.namespaced_name = '{}.{}'.format('.'.join(self.categories),
+                                              self.name)
         self._output_dir = None
-        self._categorized_name = None
         self._unique_name = None
         self._macros = None
         self._stereotype_skinparam = None
         self._sprite = None
+        self._content_hash = None
+        self._expanded_names = {}
+        self._stereotypes = {}
         self._entity_type = None
         self._color = None
         self._skinparam = None
 
     @property
-    def categorized_name(self):
-        if self._categorized_name is None:
-            basename = os.path.splitext(os.path.basename(self.image_path))[0]
-            parts = [re.sub(r'[^\w]', '_', p) for p in basename.split('_')]
-            if parts[-1] == 'LARGE':
-                self._categorized_name = parts[:-1], '_'.join(parts[-2:])
-            else:
-                self._categorized_name = parts, parts[-1]
-        return self._categorized_name
-
-    @property
-    def categories(self):
-        return self.categorized_name[0]
-
-    @property
-    def name(self):
-        return self.categorized_name[1]
-
-    @property
-    def namespaced_name(self):
-        return '{}.{}'.format('.'.join(self.categories), self.name)
+    def content_hash(self):
+        if self._content_hash is None:
+            # BLAKE2 is faster than SHA-1, and 128 bits is plenty to tell
+            # icons apart
+            h = blake2b(digest_size=16)
+            with open(self.image_path, 'rb') as f:
+                # mmap hashes straight from the page cache without copying
+                # the file into a bytes object; it can't map empty files
+                if os.fstat(f.fileno()).st_size:
+                    with mmap.mmap(f.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as mm:
+                        h.update(mm)
+            self._content_hash = h.hexdigest()
+        return self._content_hash
 
     @property
     def unique_name(self):
@@ -136,19 +443,20 @@ class PUML:
             name = self.unique_name
         return name.upper()
 
-    def _split_longer(self, parts, max_len, lines=None):
-        if lines is None:
-            lines = []
-        if not parts:
-            return lines
-        n = 1
-        line = ' '.join(parts[:n])
-        while n < len(parts) and len(' '.join(parts[:n+1])) <= max_len:
-            n += 1
-            line = ' '.join(parts[:n])
-        lines.append(line)
-        parts = parts[n:]
-        return self._split_longer(parts, max_len, lines)
+    def _split_longer(self, parts, max_len):
+        # Greedily pack parts into space-joined lines no longer than max_len,
+        # but always at least one part per line
+        lines = []
+        line, length = [], -1
+        for part in parts:
+            if line and length + 1 + len(part) > max_len:
+                lines.append(' '.join(line))
+                line, length = [], -1
+            line.append(part)
+            length += 1 + len(part)
+        if line:
+            lines.append(' '.join(line))
+        return lines
 
     def _stereotype(self, unique=True, escape=False):
         split_len = self.conf.getint('PUML', 'stereotype.split_len',
@@ -156,35 +464,40 @@ class PUML:
         name = self.name
         if not unique:
             name = self.unique_name
-        if name.endswith('_LARGE'):
-            name = '**{}**'.format(name[:-6])
-            sub = r'**\n**'
-        else:
-            sub = r'\n'
-        parts = re.split(r'_(?!\d)', name)
-        stereotype = sub.join(self._split_longer(parts, split_len))
-        if escape:
-            stereotype = stereotype.replace('\\', '\\\\')
+        # Keyed on the name itself, since unique_name is assigned after init
+        # and usually equals name anyway
+        key = (name, split_len, escape)
+        stereotype = self._stereotypes.get(key)
+        if stereotype is None:
+            if name.endswith('_LARGE'):
+                name = '**{}**'.format(name[:-6])
+                sub = r'**\n**'
+            else:
+                sub = r'\n'
+            parts = STEREOTYPE_SPLIT_RE.split(name)
+            stereotype = sub.join(self._split_longer(parts, split_len))
+            if escape:
+                stereotype = stereotype.replace('\\', '\\\\')
+            self._stereotypes[key] = stereotype
         return stereotype
 
     @property
     def macros(self):
         if self._macros is None:
-            self._macros = MACROS_TEMPLATE.format(
-                macro=self._macro(),
-                entity_type=self.entity_type,
-                color=self.color,
-                unique_name=self.unique_name,
-                stereotype=self._stereotype(),
-                esc_stereotype=self._stereotype(escape=True))
+            variants = [(self._macro(), self._stereotype(),
+                         self._stereotype(escape=True))]
             if self.name != self.unique_name:
-                self._macros += MACROS_TEMPLATE.format(
-                    macro=self._macro(False),
+                variants.append((self._macro(False), self._stereotype(False),
+                                 self._stereotype(False, True)))
+            self._macros = ''.join(
+                MACROS_TEMPLATE.format(
+                    macro=macro,
                     entity_type=self.entity_type,
                     color=self.color,
                     unique_name=self.unique_name,
-                    stereotype=self._stereotype(False),
-                    esc_stereotype=self._stereotype(False, True))
+                    stereotype=stereotype,
+                    esc_stereotype=esc_stereotype)
+                for macro, stereotype, esc_stereotype in variants)
         return self._macros
 
     @property
@@ -192,17 +505,15 @@ class PUML:
         if self._stereotype_skinparam is None:
             self._stereotype_skinparam = ''
             if self.skinparam:
-                self._stereotype_skinparam = \
+                stereotypes = [self._stereotype()]
+                if self.name != self.unique_name:
+                    stereotypes.append(self._stereotype(False))
+                self._stereotype_skinparam = ''.join(
                     STEREOTYPE_SKINPARAM_TEMPLATE.format(
                         entity_type=self.entity_type,
-                        stereotype=self._stereotype(),
+                        stereotype=stereotype,
                         skinparam=self.skinparam)
-                if self.name != self.unique_name:
-                    self._stereotype_skinparam += \
-                        STEREOTYPE_SKINPARAM_TEMPLATE.format(
-                            entity_type=self.entity_type,
-                            stereotype=self._stereotype(False),
-                            skinparam=self.skinparam)
+                    for stereotype in stereotypes)
         return self._stereotype_skinparam
 
     @property
@@ -250,90 +561,156 @@ class PUML:
             force_regen = self.conf.getboolean('PUML', 'sprite.force_regen',
                                                fallback=False)
             if os.path.isfile(self.sprite_path) and not force_regen:
-                print('Reading from existing sprite file: {}'.format(
+                _print('Reading from existing sprite file: {}'.format(
                     self.sprite_path))
-                if not os.path.isdir(self.output_dir):
-                    os.makedirs(self.output_dir)
                 with open(self.sprite_path, 'r') as f:
-                    lines = f.readlines()
-                self._sprite = ''.join(lines)
-            else:
+                    sprite = f.read()
+                # Adding or removing another icon can change unique_name, so
+                # the file may not define the sprites the macros refer to
+                if (set(SPRITE_NAME_RE.findall(sprite)) ==
+                        {self.name, self.unique_name}):
+                    self._sprite = sprite
+                else:
+                    _print('Sprite names changed, regenerating: {}'.format(
+                        self.sprite_path))
+            if self._sprite is None:
                 self._sprite = self.generate_sprite()
-                print('Writing sprite file: {}'.format(self.sprite_path))
-                if not os.path.isdir(self.output_dir):
-                    os.makedirs(self.output_dir)
+                _print('Writing sprite file: {}'.format(self.sprite_path))
+                _ensure_dir(self.output_dir)
                 with open(self.sprite_path, 'w') as f:
                     f.write(self._sprite)
         return self._sprite
 
+    def encode_sprite(self, size):
+        """Return PlantUML's raw ``-encodesprite`` output (bytes).
+
+        Results are cached in SPRITE_CACHE_DIR by image content and encoder,
+        so renamed or moved icons and re-runs over unchanged icon sets skip
+        Java. sprite.force_regen bypasses the cache lookup.
+        """
+        # Look-alike icons share the encoding of the first one found
+        source = self.duplicate_of or self
+        tag = 'java' if self.encoder is None else self.encoder.cache_tag
+        cache_path = sprite_cache_path(source.content_hash, size, tag)
+        # A forced regeneration still refreshes the cached copy
+        if not self.conf.getboolean('PUML', 'sprite.force_regen',
+                                    fallback=False):
+            try:
+                with open(cache_path, 'rb') as f:
+                    return f.read()
+            except OSError:
+                pass
+        if self.encoder is not None:
+            output = self.encoder.encode(size, source.image_path)
+        else:
+            output = encode_sprite(size, source.image_path)
+        # The cache is only an optimization, so e.g. a read-only checkout
+        # just means every run encodes its sprites again
+        try:
+            _ensure_dir(SPRITE_CACHE_DIR)
+            # Write-then-rename, as identical icons may be encoded concurrently
+            tmp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(output)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            _print('Could not cache sprite for {}: {}'.format(
+                source.image_path, e))
+        return output
+
     def generate_sprite(self):
         size = self.conf.get('PUML', 'sprite.size', fallback='16')
         shift = self.conf.getint('PUML', 'sprite.shift', fallback=0)
         ignore = self.conf.get('PUML', 'sprite.shift_ignore', fallback='0')
-        cmd = ['java', '-Djava.awt.headless=true', '-jar', PUML_JAR,
-               '-encodesprite',
-               size,
-               self.image_path]
-        output = subprocess.check_output(cmd, universal_newlines=True)
-        sprite_lines = []
-        lines = output.split('\n')
+        # PlantUML prints the header, one line of hex digits per pixel row,
+        # the closing brace and a blank line
+        lines = self.encode_sprite(size).splitlines()
+        header = lines[0].decode('utf-8')
+        # Pixel rows are joined once so every pass over them is a single call
+        body = b'\n'.join(lines[1:-2])
+        footer = [line.decode('ascii') for line in lines[-2:]]
+        table = shift_table(shift, ignore) if shift else None
         if self.conf.getboolean(self.namespaced_name, 'make_transparent',
                                 fallback=False):
-            lines[1:-3] = [l.upper().replace('F', '0') for l in lines[1:-3]]
-        darkest = '0'
-        for line in lines[1:-3]:
-            darkest = max(darkest, max(line))
-        if not shift:
-            shift = 15 - int(darkest, base=16)
-        lines[0] = re.sub(r'^(\s*sprite\s+\$)\w+(\s+\[\d+x\d+/\d+\]\s*\{\s*)$',
-                          r'\g<1>{}\g<2>'.format(self.name),
-                          lines[0],
-                          re.I)
-        sprite_lines.append(lines[0])
-        for line in lines[1:-3]:
-            new_line = ''
-            for c in line:
-                if c not in ignore:
-                    # shift up to 15/F, convert to hex and strip leading '0x'
-                    c = hex(min(15, shift + int(c, base=16))).upper()[-1]
-                new_line += c
-            sprite_lines.append(new_line)
-        sprite_lines.extend(lines[-3:])
-        sprite = '\n'.join(sprite_lines)
+            if table:
+                # With a fixed shift, both mappings fold into one table
+                table = TRANSPARENT_TABLE.translate(table)
+            else:
+                body = body.translate(TRANSPARENT_TABLE)
+        if table is None:
+            # The newlines sort below '0', so they never win
+            darkest = max(ord('0'), max(body, default=0))
+            table = shift_table(15 - int(chr(darkest), base=16), ignore)
+        header = SPRITE_HEADER_RE.sub(r'\g<1>{}\g<2>'.format(self.name),
+                                      header)
+        body = body.translate(table)
+        sprite_lines = [header, body.decode('ascii')] + footer
+        # splitlines() dropped the newline ending the output
+        sprite = '\n'.join(sprite_lines) + '\n'
         if self.name != self.unique_name:
             sprite_lines[0] = sprite_lines[0].replace(self.name,
                                                       self.unique_name, 1)
-            sprite += '\n'.join(sprite_lines)
+            sprite += '\n'.join(sprite_lines) + '\n'
         return sprite
 
     def expand_name(self, levels=0):
-        levels = max(0, len(self.categories) - levels - 1)
-        return '_'.join(self.categories[levels:-1] + [self.name])
-
-    def write_puml(self):
-        content = PUML_TEMPLATE.format(
-            sprite=self.sprite,
-            stereotype_skinparam=self.stereotype_skinparam,
-            macros=self.macros)
-        if not os.path.isdir(self.output_dir):
-            os.makedirs(self.output_dir)
-        print('Writing PUML file to: {}'.format(self.puml_path))
-        with open(self.puml_path, 'w') as f:
+        expanded = self._expanded_names.get(levels)
+        if expanded is None:
+            start = max(0, len(self.categories) - levels - 1)
+            expanded = '_'.join(self.categories[start:-1] + [self.name])
+            self._expanded_names[levels] = expanded
+        return expanded
+
+    def _puml_matches(self, content):
+        try:
+            with open(self.puml_path, 'r') as f:
+                return f.read() == content
+        except (OSError, ValueError):
+            return False
+
+    def write_puml(self, force=False):
+        # The content is always rebuilt, since it also depends on the other
+        # icons (unique_name) and on the options; only the write is skipped
+        content = ''.join((self.sprite, '\n', self.stereotype_skinparam,
+                           '\n', self.macros))
+        if not force and self._puml_matches(content):
+            _print('Skipping up-to-date PUML file: {}'.format(self.puml_path))
+            return
+        _ensure_dir(self.output_dir)
+        _print('Writing PUML file to: {}'.format(self.puml_path))
+        with open(self.puml_path, 'w', buffering=1 << 16) as f:
             f.write(content)
 
 
 def find_images(path, ext='.png'):
-    path = os.path.abspath(path)
-    for root, dirs, files in os.walk(path):
-        for fname in files:
-            if fname.lower().endswith(ext):
-                yield os.path.join(root, fname)
+    # Same top-down order as os.walk, without building its per-directory
+    # name lists and re-joining every path
+    dirs = []
+    # Only the tail is lower-cased, so .PNG and .Png still match
+    n = len(ext)
+    with os.scandir(os.path.abspath(path)) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+            elif entry.name[len(entry.name) - n:].lower() == ext:
+                yield entry.path
+    for d in dirs:
+        try:
+            yield from find_images(d, ext)
+        except OSError:
+            pass
 
 
 def set_unique_names(pumls, expand=0):
-    pumls = sorted(pumls, key=lambda p: p.expand_name(expand))
-    for k, g in groupby(pumls, key=lambda p: p.expand_name(expand)):
-        g = list(g)
+    groups = defaultdict(list)
+    for p in pumls:
+        groups[p.expand_name(expand)].append(p)
+    for k, g in groups.items():
         if len(g) == 1:
             g[0].unique_name = k
         else:
@@ -341,17 +718,67 @@ def set_unique_names(pumls, expand=0):
 
 
 def filter_duplicate_images(pumls):
-    def shasum(puml):
-        h = sha1()
-        with open(puml.image_path, 'rb') as f:
-            h.update(f.read())
-        return h.hexdigest()
-
-    pumls = sorted(pumls, key=shasum)
-    for k, g in groupby(pumls, key=shasum):
-        g = list(g)
-        if len(g) == 1:
-            yield g[0]
+    # Files can only be identical if their sizes match, so only hash those
+    sizes = defaultdict(list)
+    for p in pumls:
+        sizes[os.path.getsize(p.image_path)].append(p)
+    # Hashing is I/O bound and releases the GIL, so warm up content_hash
+    # for every size collision from a thread pool
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(attrgetter('content_hash'),
+                          [p for g in sizes.values() if len(g) > 1
+                           for p in g]))
+    for same_size in sizes.values():
+        if len(same_size) == 1:
+            yield same_size[0]
+            continue
+        digests = defaultdict(list)
+        for p in same_size:
+            digests[p.content_hash].append(p)
+        for g in digests.values():
+            if len(g) == 1:
+                yield g[0]
+
+
+def pixel_hash(image_path):
+    """Return a digest of the image's decoded pixels, size and format.
+
+    Requires Pillow. Files that decode to exactly the same pixels, such as
+    an icon re-exported with different compression or metadata, hash the
+    same. The raw pixel format and any color profile are part of the key,
+    since PlantUML reads e.g. grayscale PNGs differently from color ones.
+    """
+    from PIL import Image
+    h = blake2b(digest_size=16)
+    with Image.open(image_path) as im:
+        rawmode = im.tile[0][3] if im.tile else None
+        h.update('{} {} {} {!r}\n'.format(im.format, im.size, im.mode,
+                                          rawmode).encode('utf-8'))
+        h.update(im.info.get('icc_profile') or b'')
+        h.update(im.convert('RGBA').tobytes())
+    return h.hexdigest()
+
+
+def filter_same_pixel_images(pumls):
+    """Filter out icons whose pixels are identical, even if their bytes differ.
+
+    Such icons are treated like byte-identical duplicates, and all but the
+    first of them reuse the first one's sprite encoding instead of running
+    Java again.
+    """
+    pumls = list(pumls)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        hashes = list(executor.map(pixel_hash,
+                                   [p.image_path for p in pumls]))
+    groups = defaultdict(list)
+    for puml, h in zip(pumls, hashes):
+        groups[h].append(puml)
+    for group in groups.values():
+        if len(group) == 1:
+            yield group[0]
+        else:
+            for puml in group[1:]:
+                puml.duplicate_of = group[0]
 
 
 def create_test_puml(conf, output_path, pumls):
@@ -364,39 +791,45 @@ def create_test_puml(conf, output_path, pumls):
     debug_uri = debug_uri.rstrip('/')
     test_puml = os.path.join(output_path, 'test.puml')
     print('Writing test puml: {}'.format(test_puml))
+    buf = io.StringIO()
+    buf.write('@startuml\n')
+    buf.write('!define PUML {}\n'.format(debug_uri))
+    buf.write('{} PUML/common.puml\n\n'.format(include_prefix))
+    for puml in pumls:
+        buf.write('\'{} PUML/{}\n'.format(
+            include_prefix,
+            os.path.relpath(puml.puml_path, output_path)))
+        buf.write('\'{macro}({name},{name})\n\n'.format(
+            macro=puml.unique_name.upper(),
+            name=puml.name))
+    buf.write('@enduml\n')
     with open(test_puml, 'w') as f:
-        f.write('@startuml\n')
-        f.write('!define PUML {}\n'.format(debug_uri))
-        f.write('{} PUML/common.puml\n\n'.format(include_prefix))
-        for puml in pumls:
-            f.write('\'{} PUML/{}\n'.format(
-                include_prefix,
-                os.path.relpath(puml.puml_path, output_path)))
-            f.write('\'{macro}({name},{name})\n\n'.format(
-                macro=puml.unique_name.upper(),
-                name=puml.name))
-        f.write('@enduml\n')
-
-
-def create_pumls(conf, output_path, pumls):
+        f.write(buf.getvalue())
+
+
+def create_pumls(conf, output_path, pumls, jobs=None, force=False):
     output_path = os.path.abspath(output_path)
-    for puml in pumls:
-        puml.write_puml()
-    shutil.copy(os.path.join(SRC_DIR, 'common.puml'), output_path)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # list() re-raises the first exception from any worker thread
+        list(executor.map(lambda puml: puml.write_puml(force), pumls))
+    shutil.copyfile(os.path.join(SRC_DIR, 'common.puml'),
+                    os.path.join(output_path, 'common.puml'))
     if conf.getboolean('PUML', 'debug', fallback=False):
         create_test_puml(conf, output_path, pumls)
         map_file = os.path.join(output_path, 'file-map.yml')
         puml_files = [os.path.join(output_path, f) for f in ('common.puml', 'file-map.yml', 'test.puml')]
         print('Writing file name map: {}'.format(map_file))
+        buf = io.StringIO()
+        buf.write('---\n\n')
+        for puml in sorted(pumls, key=attrgetter('namespaced_name')):
+            puml_files.append(puml.puml_path)
+            puml_files.append(puml.sprite_path)
+            buf.write('{}:\n\t- {}\n\t- {}\n\t- {}\n\n'.format(puml.namespaced_name,
+                                                               puml.image_path,
+                                                               puml.puml_path,
+                                                               puml.sprite_path))
         with open(map_file, 'w') as f:
-            f.write('---\n\n')
-            for puml in sorted(pumls, key=attrgetter('namespaced_name')):
-                puml_files.append(puml.puml_path)
-                puml_files.append(puml.sprite_path)
-                f.write('{}:\n\t- {}\n\t- {}\n\t- {}\n\n'.format(puml.namespaced_name,
-                                                                 puml.image_path,
-                                                                 puml.puml_path,
-                                                                 puml.sprite_path))
+            f.write(buf.getvalue())
         for root, dirs, files in os.walk(output_path):
             for fname in files:
                 fpath = os.path.join(root, fname)
@@ -422,41 +855,47 @@ def create_ini(conf, path, pumls):
         conf.remove_section(section)
     print('Writing INI file: {}'.format(path))
     default_options = conf.defaults().keys()
-    with open(path, 'w') as f:
-        for section in CONFIG_DEFAULTS.keys():
-            f.write('[{}]\n'.format(section))
-            for k, v in conf.items(section, raw=True):
-                if k in default_options and section != conf.default_section:
-                    continue
-                # For multiline opts, re-add indent equal with start of opt val
-                v = v.replace('\n', '{:<{ind}}'.format('\n', ind=len(k) + 3))
-                f.write('{}: {}\n'.format(k, v))
-            f.write('\n')
-        for section in sorted(conf.sections()):
-            if section in CONFIG_DEFAULTS:
+    sections = list(CONFIG_DEFAULTS.keys())
+    sections += [s for s in sorted(conf.sections())
+                 if s not in CONFIG_DEFAULTS]
+    buf = io.StringIO()
+    for section in sections:
+        buf.write('[{}]\n'.format(section))
+        for k, v in conf.items(section, raw=True):
+            if k in default_options and section != conf.default_section:
                 continue
-            f.write('[{}]\n'.format(section))
-            for k, v in conf.items(section, raw=True):
-                if k in default_options and section != conf.default_section:
-                    continue
-                # For multiline opts, re-add indent equal with start of opt val
-                v = v.replace('\n', '{:<{ind}}'.format('\n', ind=len(k) + 3))
-                f.write('{}: {}\n'.format(k, v))
-            f.write('\n')
+            # For multiline opts, re-add indent equal with start of opt val
+            v = v.replace('\n', '\n' + ' ' * (len(k) + 2))
+            buf.write('{}: {}\n'.format(k, v))
+        buf.write('\n')
+    with open(path, 'w') as f:
+        f.write(buf.getvalue())
 
 
-def get_pumls(conf, icons_path, output_path, icon_ext='.png'):
+def get_pumls(conf, icons_path, output_path, icon_ext='.png', encoder=None,
+              pixel_dedup=False):
     icons_path = os.path.abspath(icons_path)
     if not os.path.isdir(icons_path):
         raise Exception('Invalid Icons path: %s' % icons_path)
     output_path = os.path.abspath(output_path)
 
     icons = find_images(icons_path, icon_ext)
-    pumls = [PUML(p, output_path, conf) for p in icons]
-    set_unique_names(filter_duplicate_images(pumls))
+    pumls = [PUML(p, output_path, conf, encoder) for p in icons]
+    unique_pumls = filter_duplicate_images(pumls)
+    if pixel_dedup:
+        unique_pumls = filter_same_pixel_images(unique_pumls)
+    set_unique_names(unique_pumls)
     return pumls
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'must be at least 1, got {}'.format(value))
+    return number
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Generate PlantUML sprites and macros from images',
@@ -464,6 +903,10 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config',
                         default=CONFIG_FILE,
                         help='Config file for puml generation')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Rewrite all .puml files, even those whose '
+                             'content would not change')
     parser.add_argument('-g', '--generate_config',
                         action='store_true',
                         help='Write all sections to the INI file specified by '
@@ -471,21 +914,58 @@ if __name__ == '__main__':
                              'its sections and options will be preserved, but '
                              'missing sections will be added and invalid '
                              'sections will be deleted.')
+    parser.add_argument('-j', '--jobs',
+                        type=positive_int,
+                        default=os.cpu_count(),
+                        help='Number of icons to process in parallel')
     parser.add_argument('-o', '--output',
                         default=OUTPUT_DIR,
                         help='Output path for generated .puml files')
+    parser.add_argument('--java-workers',
+                        type=positive_int,
+                        default=4,
+                        help='Maximum number of Java sprite workers to run '
+                             'at once; each is a separate JVM')
+    parser.add_argument('--pixel-dedup',
+                        action='store_true',
+                        help='Also treat icons whose files differ but whose '
+                             'decoded pixels are identical (e.g. re-exported '
+                             'copies) as duplicates, and encode their sprite '
+                             'only once; icons that merely look alike are not '
+                             'merged (requires Pillow)')
+    parser.add_argument('--pillow',
+                        action='store_true',
+                        help='Encode 16-level sprites of color PNGs with '
+                             'Pillow instead of Java; the output is the same '
+                             '(requires Pillow)')
     parser.add_argument('icons_path',
                         help='Path to image icons directory')
     args = parser.parse_args()
+    for flag, wanted in (('--pixel-dedup', args.pixel_dedup),
+                         ('--pillow', args.pillow)):
+        if wanted:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                parser.error('{} requires Pillow'.format(flag))
 
     config = InheritingConfigParser(
         interpolation=configparser.ExtendedInterpolation())
     config.read_dict(CONFIG_DEFAULTS)
     config.read(args.config)
 
-    puml_objs = get_pumls(config, args.icons_path, args.output)
-
-    if args.generate_config:
-        create_ini(config, args.config, puml_objs)
-    create_pumls(config, args.output, puml_objs)
+    # More JVMs than threads would never be used
+    java_workers = min(args.java_workers, args.jobs)
+    with SpriteEncoder(workers=java_workers) as sprite_encoder:
+        encoder = sprite_encoder
+        if args.pillow:
+            encoder = PillowSpriteEncoder(sprite_encoder)
+        puml_objs = get_pumls(config, args.icons_path, args.output,
+                              encoder=encoder,
+                              pixel_dedup=args.pixel_dedup)
+
+        if args.generate_config:
+            create_ini(config, args.config, puml_objs)
+        create_pumls(config, args.output, puml_objs, args.jobs,
+                     force=args.force)
     print('done!')